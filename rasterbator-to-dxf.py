@@ -25,27 +25,41 @@
 
 import argparse
 import os
+import re
+import subprocess
+import xml.etree.ElementTree as ET
+from itertools import chain, islice
+from multiprocessing import Pool
 
 import ezdxf as dx
 import matplotlib.pyplot as plt
 import numpy as np
-import pdfplumber
+import pypdfium2 as pdfium
 from ezdxf import units
-from scipy.spatial import distance
-from svgpathtools import svg2paths
-from svgpathtools.path import CubicBezier
+from ezdxf.entities import factory
+from numba import njit
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
 doc_out = dx.new('R2010')
 doc_out.units = units.IN
+msp_out = doc_out.modelspace()
 
-diams = []
+diams = np.empty(0, dtype=np.float32)
 a0_points = [(0, 0), (46.8, 0), (46.8, 33.1), (0, 33.1)]
 a4_points = [(0, 0), (11.7, 0), (11.7, 8.3), (0, 8.3)]
 page_points = a0_points
 min_diam = 1.5
 pdftocairo_dpi = 72
-coords = []
+inv_dpi = 1.0 / pdftocairo_dpi
+mm_per_inch = 25.4
+max_workers = 8
+pool_min_paths = 20000
+coords = np.empty((0, 3), dtype=np.float64)
+num_circles = 0
+svg_path_tag = '{http://www.w3.org/2000/svg}path'
+svg_number_re = re.compile(r'-?(?:\d+\.?\d*|\.\d+)')
+svg_cubic_chars = str.maketrans('', '', 'MCZ0123456789.-, \t\r\n')
 
 def get_page_points(path):
     """
@@ -53,11 +67,13 @@ def get_page_points(path):
     :param path: pth to PDF file
     :return: extent points
     """
-    with pdfplumber.open(path) as pdf:
-        page_1 = pdf.pages[0]
-        w = float(page_1.width) / pdftocairo_dpi
-        h = float(page_1.height) / pdftocairo_dpi
-        return [(0, 0), (w, 0), (w, h), (0, h)]
+    pdf = pdfium.PdfDocument(path)
+    w, h = pdf[0].get_size()
+    pdf.close()
+
+    w /= pdftocairo_dpi
+    h /= pdftocairo_dpi
+    return [(0, 0), (w, 0), (w, h), (0, h)]
 
 
 def is_valid_file(arg_parse, arg):
@@ -75,54 +91,162 @@ def is_valid_file(arg_parse, arg):
         return arg
 
 
+@njit(cache=True, fastmath=True)
+def get_bbox(points):
+    """
+    Calculate bounding box of points
+    :param points: array of points with shape (n, 2)
+    :return: bounding box (x_min, x_max, y_min, y_max)
+    """
+    if len(points) == 0:
+        raise ValueError('bounding box of empty points')
+
+    x_min = x_max = points[0, 0]
+    y_min = y_max = points[0, 1]
+
+    for i in range(1, len(points)):
+        x = points[i, 0]
+        y = points[i, 1]
+        if x < x_min:
+            x_min = x
+        elif x > x_max:
+            x_max = x
+        if y < y_min:
+            y_min = y
+        elif y > y_max:
+            y_max = y
+
+    return x_min, x_max, y_min, y_max
+
+
 def get_center_and_radius(points):
     """
     Calculate bounding box of points in polyline and return center and diameter of fitting circle
     :param points: Points in the polyline
-    :return: center of circle (x,y) and radius
+    :return: center of circle (x,y) and radius or None if the polyline has no points
+    """
+    if len(points) == 0:
+        return None
+
+    points = np.fromiter((v for p in points for v in p), dtype=np.float64, count=2 * len(points)).reshape(-1, 2)
+    x_min, x_max, y_min, y_max = get_bbox(points)
+
+    return ((x_min + x_max) / 2, (y_min + y_max) / 2), (y_max - y_min) / 2
+
+
+def read_svg_paths(path):
+    """
+    Convert the first page of a PDF with pdftocairo and stream the path data of its svg output
+    :param path: path to PDF file
+    :return: generator of the path data of all svg path elements
+    """
+    cmd = ['pdftocairo', '-f', '0', '-l', '0', '-svg', '-origpagesizes', path, '-']
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        try:
+            # open elements, finished elements are removed from their parent to keep memory constant
+            stack = []
+            for event, e in ET.iterparse(proc.stdout, events=('start', 'end')):
+                if event == 'start':
+                    stack.append(e)
+                    continue
+
+                stack.pop()
+                if e.tag == svg_path_tag:
+                    yield e.get('d', '')
+                if stack:
+                    stack[-1].remove(e)
+        except ET.ParseError:
+            # incomplete output is most likely caused by pdftocairo failing
+            proc.stdout.close()
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            raise
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def get_bbox_svg(d):
+    """
+    Calculate bounding box of the control points of a svg path consisting of four cubic bezier curves
+    :param d: path data of svg element
+    :return: bounding box (x_min, x_max, y_min, y_max) or None if the path is not a circle
+    """
+    if d.count('C') != 4 or d.translate(svg_cubic_chars):
+        return None
+
+    numbers = svg_number_re.findall(d)
+    if len(numbers) < 2 or len(numbers) % 2:
+        return None
+
+    return get_bbox(np.array(numbers, dtype=np.float64).reshape(-1, 2))
+
+
+def get_bboxes_svg(paths):
+    """
+    Calculate bounding boxes of svg paths, in a process pool if there are many paths and cpus
+    :param paths: iterable of path data of svg elements
+    :return: list of bounding boxes (x_min, x_max, y_min, y_max) or None for paths which are not circles
     """
-    x_coordinates, y_coordinates = zip(*points)
+    paths = iter(paths)
+    head = list(islice(paths, pool_min_paths))
+    workers = min(os.cpu_count() or 1, max_workers)
 
-    x_min = min(x_coordinates)
-    x_max = max(x_coordinates)
-    y_min = min(y_coordinates)
-    y_max = max(y_coordinates)
+    if len(head) < pool_min_paths or workers < 2:
+        return [get_bbox_svg(d) for d in chain(head, paths)]
 
-    x_diff = (x_max - x_min) / 2
-    y_diff = (y_max - y_min) / 2
+    # compile the kernel before the pool is created, so forked workers inherit it
+    get_bbox(np.zeros((1, 2)))
 
-    return (x_min + x_diff, y_min + y_diff), y_diff
+    with Pool(workers) as pool:
+        return list(pool.imap(get_bbox_svg, chain(head, paths), chunksize=256))
 
 
-def get_center_and_radius_svg(bbox):
+def get_center_and_radius_svg(bbox, page_h):
     """
     calculate center and diameter of fitting circle from bounding box
     :param bbox: Bounding box of svg element
+    :param page_h: page height in inches, used to flip the svg y axis
     :return: center of circle (x,y) and radius
     """
-    x_min, x_max, y_min, y_max = [v / pdftocairo_dpi for v in bbox]
-    y_max_new = max(page_points)[1] - y_min
-    y_min_new = max(page_points)[1] - y_max
+    x_min, x_max, y_min, y_max = bbox
 
-    x_diff = (x_max - x_min) / 2
-    y_diff = (y_max_new - y_min_new) / 2
+    return ((x_min + x_max) * inv_dpi / 2, page_h - (y_min + y_max) * inv_dpi / 2), (y_max - y_min) * inv_dpi / 2
 
-    return (x_min + x_diff, y_min_new + y_diff), y_diff
+
+def init_circles(n):
+    """
+    Allocates the output buffers for a maximum number of circles
+    :param n: maximum number of circles
+    """
+    global coords, diams, num_circles
+    coords = np.empty((n, 3), dtype=np.float64)
+    diams = np.empty(n, dtype=np.float32)
+    num_circles = 0
 
 
 def add_circle_to_output(center, radius):
     """
-    Adds a circle to the output file
+    Adds a circle to the output buffer
     :param center: center coordinates (x,y)
     :param radius: radius of the circle
     """
-    diam_mm = radius * 25.4 * 2
-    diam_mm = round(diam_mm * 2) / 2
+    global num_circles
+
+    diam_mm = round(radius * mm_per_inch * 4) / 2
 
     if diam_mm >= min_diam:
-        diams.append(diam_mm)
-        coords.append((center[0] * 25.4, center[1] * 25.4, diam_mm / 2))
-        doc_out.modelspace().add_circle(center, diam_mm / 2 / 25.4)
+        diams[num_circles] = diam_mm
+        coords[num_circles] = center[0] * mm_per_inch, center[1] * mm_per_inch, diam_mm / 2
+        num_circles += 1
+
+
+def write_circles():
+    """
+    Writes all collected circles to the output file
+    """
+    for x, y, r in (coords / mm_per_inch).tolist():
+        msp_out.add_entity(factory.create_db_entry('CIRCLE', {'center': (x, y, 0), 'radius': r}, doc_out))
 
 
 def polyline_to_circle(line):
@@ -131,8 +255,9 @@ def polyline_to_circle(line):
     :param line: Polyline
     """
     with line.points('xy') as points:
-        center, radius = get_center_and_radius(points)
-        add_circle_to_output(center, radius)
+        circle = get_center_and_radius(points)
+        if circle is not None:
+            add_circle_to_output(*circle)
 
 
 if __name__ == '__main__':
@@ -165,56 +290,69 @@ if __name__ == '__main__':
         doc.units = units.IN
         msp = doc.modelspace()
 
-        num_entities = msp.query('LWPOLYLINE').__len__()
+        polylines = msp.query('LWPOLYLINE')
+        num_entities = len(polylines)
 
         print(f'{num_entities} entities of type "LWPOLYLINE" found!')
 
-        for e in tqdm(msp):
-            if e.dxftype() == 'LWPOLYLINE':
-                polyline_to_circle(e)
+        init_circles(num_entities)
+
+        for e in tqdm(polylines):
+            polyline_to_circle(e)
     else:
         page_points = get_page_points(args.infile)
-        temp_svg = os.path.dirname(args.infile) + '/temp.svg'
-        print(f'Converting "{args.infile}" with tool "pdftocairo" to {temp_svg} ...', end=' ')
-        os.system(f'pdftocairo -f 0 -l 0 -svg -origpagesizes {args.infile} {temp_svg}')
+        page_h = max(page_points)[1]
 
-        paths, attrs = svg2paths(temp_svg)
-        os.remove(temp_svg)
-
-        print("DONE")
-
-        print(f'Parsing input file "{args.infile}" for circular features ...', end=' ')
-        circles = [get_center_and_radius_svg(p.bbox()) for p in paths if
-                   all(map(lambda e: isinstance(e, CubicBezier), p._segments))]
+        print(f'Converting "{args.infile}" with tool "pdftocairo" and parsing it for circular features ...', end=' ')
+        bboxes = get_bboxes_svg(read_svg_paths(args.infile))
+        circles = [get_center_and_radius_svg(bbox, page_h) for bbox in bboxes if bbox is not None]
 
         print(f'{len(circles)} features found!')
 
+        init_circles(len(circles))
+
         for center, radius in tqdm(circles):
             add_circle_to_output(center, radius)
 
-        # calculate distances between circle outlines
-        coords = np.asarray(coords)
-        coords[:, 2] = np.around(coords[:, 2] * 2) / 2
-
-        rr, rrr = np.meshgrid(coords[:, 2], coords[:, 2])
-        dists = np.abs(np.tril(distance.cdist(coords[:, :1], coords[:, :1]) - rr - rrr))
-        dists = dists[dists != 0.0]
+    coords = coords[:num_circles]
+    diams = diams[:num_circles]
 
-    doc_out.modelspace().add_lwpolyline(page_points, close=True)
+    write_circles()
+    msp_out.add_lwpolyline(page_points, close=True)
     doc_out.saveas(args.outfile)
     print(f'Output file "{args.outfile}" saved!')
 
     print(f"Number of circles: {len(diams)}")
-    print(f"Minimum diameter: {min(diams):.2f} mm")
-    print(f"Maximum diameter: {max(diams):.2f} mm")
-    print(f"Minimum distance: {np.min(dists):.2f} mm")
-    print(f"Maximum distance: {np.max(dists):.2f} mm")
-    print(f"Mean distance: {np.mean(dists):.2f} mm")
+    if num_circles:
+        print(f"Minimum diameter: {diams.min():.2f} mm")
+        print(f"Maximum diameter: {diams.max():.2f} mm")
+
+    if num_circles >= 2:
+        # calculate distances between the outlines of neighbouring circles
+        x, y, r = coords.T.astype(np.float32)
+        r = np.around(r * 2) / 2
+        tree = cKDTree(coords[:, :2])
+        pairs = tree.query_pairs(4 * r.max(), output_type='ndarray')
+        if not len(pairs):
+            # no circles close to each other, fall back to the nearest neighbour of every circle
+            pairs = np.column_stack((np.arange(num_circles), tree.query(coords[:, :2], k=2)[1][:, 1]))
+            # mutual nearest neighbours would be counted twice
+            pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+        i, j = pairs.T
+        dists = np.abs(np.hypot(x[i] - x[j], y[i] - y[j]) - r[i] - r[j])
+        dist_hist, dist_edges = np.histogram(dists, 50)
+
+        print(f"Minimum distance to neighbouring circles: {np.min(dists):.2f} mm")
+        print(f"Maximum distance to neighbouring circles: {np.max(dists):.2f} mm")
+        print(f"Mean distance to neighbouring circles: {np.mean(dists):.2f} mm")
 
     if args.plot_hist:
         fig, ax = plt.subplots(1, 2, figsize=(16, 6))
-        n, bins, patches = ax[0].hist(diams, 50, alpha=0.75)
-        n, bins, patches = ax[1].hist(dists.flatten(), 50, alpha=0.75)
+        # diameters are rounded to 0.5 mm, so every distinct value is its own bin
+        diam_values, diam_counts = np.unique(diams, return_counts=True)
+        ax[0].bar(diam_values, diam_counts, width=0.5, alpha=0.75)
+        if num_circles >= 2:
+            ax[1].bar(dist_edges[:-1], dist_hist, width=np.diff(dist_edges), align='edge', alpha=0.75)
 
         ax[0].set_xlabel('Diameter')
         ax[0].set_ylabel('Count')
@@ -223,7 +361,7 @@ if __name__ == '__main__':
 
         ax[1].set_xlabel('Distances')
         ax[1].set_ylabel('Count')
-        ax[1].set_title('Histogram of the distances between circles to cut')
+        ax[1].set_title('Histogram of the distances between neighbouring circles to cut')
         ax[1].grid(True)
         plt.tight_layout()
         plt.show()